@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+# -------------------------------------------------------------------
+# Benchmark for the remote reading path (get_data -> extraction)
+#
+# Runs get_data, reading all data, and (optionally) the full extraction
+# of prepare_stationdata.main against the local mock zarr server for a
+# set of network scenarios (latency/bandwidth) and reports wall time as
+# well as the number of requests and bytes transferred. Reading is timed
+# separately as the extraction is dominated by CPU work (modify_date).
+# Failing tasks (e.g., with --error_rate) are reported in the table.
+#
+# Usage: python bench/bench_get_data.py [--stations 10] [--steps 21] [--retries 3] [--extraction]
+#
+# Authors: Thorsten Simon and Reto Stauffer
+# Date: 2022-09-16
+# -------------------------------------------------------------------
+
+import sys
+import os
+import time
+import shutil
+import asyncio
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from functions import get_data
+from prepare_stationdata import main
+from mock_zarr_server import MockZarrServer, make_eupp_store
+
+import logging as log
+log.basicConfig(level = log.INFO)
+
+# Network scenarios: name, latency [s], bandwidth [bytes/s]
+SCENARIOS = [("local",     0.,   None),
+             ("lan",       0.002, 100e6),
+             ("wan",       0.03,  20e6),
+             ("slow",      0.1,   2e6)]
+
+
+# -------------------------------------------------------------------
+def retry_middleware(retries, backoff = 0.05):
+    """retry_middleware(retries, backoff = 0.05)
+
+    aiohttp client middleware retrying requests answered with a server
+    error (5xx) up to `retries` times with exponential backoff; used
+    via `storage_options = {"client_kwargs": {"middlewares": [...]}}`.
+    """
+    async def middleware(request, handler):
+        for i in range(retries + 1):
+            response = await handler(request)
+            if response.status < 500 or i == retries: return response
+            response.release()
+            await asyncio.sleep(backoff * 2**i)
+    return middleware
+
+
+# -------------------------------------------------------------------
+def run_task(res, server, name, task, fun):
+    """run_task(res, server, name, task, fun)
+
+    Calls `fun()` and appends timing and request statistics to `res`;
+    exceptions are caught and reported as failed task.
+
+    Return
+    ------
+    bool : True if the task succeeded.
+    """
+    server.reset_stats()
+    t0 = time.perf_counter()
+    try:
+        fun()
+        status = "ok"
+    except Exception as e:
+        log.error(f"Task {task} ({name}) failed: {e!r}")
+        status = f"failed ({type(e).__name__})"
+    res.append({"scenario": name, "task": task, "seconds": time.perf_counter() - t0,
+                "status": status, **server.summary()})
+    return status == "ok"
+
+
+# -------------------------------------------------------------------
+def run_scenario(root, name, latency, bandwidth, error_rate, country, param,
+                 storage_options = None, extraction = False):
+    """run_scenario(root, name, latency, bandwidth, error_rate, country, param,
+                    storage_options = None, extraction = False)
+
+    Return
+    ------
+    list : List of dicts with timing, status and request statistics; one
+    for opening the stores (get_data), one for reading all data (read)
+    and, if `extraction = True`, one for the full extraction (main).
+    Tasks depending on a failed task are skipped.
+    """
+    res  = []
+    data = {}
+    with MockZarrServer(root, latency = latency, bandwidth = bandwidth,
+                        error_rate = error_rate, seed = 1) as server:
+
+        # Opening the stores only (metadata)
+        def fun():
+            for reforecast in [True, False]:
+                data[reforecast] = get_data(country, param, reforecast, do_cache = False,
+                                            server_path = server.url, storage_options = storage_options)
+        if not run_task(res, server, name, "get_data", fun): return res
+
+        # Reading all data (transfer and decompression only)
+        def fun():
+            for reforecast in [True, False]:
+                for x in data[reforecast]: x[param].load()
+        if not run_task(res, server, name, "read", fun) or not extraction: return res
+
+        # Full extraction in a temporary working directory
+        keepwd  = os.getcwd()
+        workdir = tempfile.mkdtemp(prefix = "_bench_")
+        try:
+            os.chdir(workdir)
+            run_task(res, server, name, "extraction",
+                     lambda: main({"prefix": "euppens", "country": country, "param": param, "nocache": True,
+                                   "server": server.url, "storage_options": storage_options}))
+        finally:
+            os.chdir(keepwd)
+            shutil.rmtree(workdir)
+    return res
+
+
+# -------------------------------------------------------------------
+# Main part of the Script
+# -------------------------------------------------------------------
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(f"{sys.argv[0]}")
+    parser.add_argument("-s", "--stations", type = int, default = 10,
+            help = "Number of stations in the generated stores.")
+    parser.add_argument("-n", "--steps", type = int, default = 21,
+            help = "Number of steps in the generated stores.")
+    parser.add_argument("-y", "--years", type = int, default = 20,
+            help = "Number of reforecast years in the generated stores.")
+    parser.add_argument("--scenario", type = str, nargs = "+", default = None,
+            choices = [x[0] for x in SCENARIOS],
+            help = "Scenarios to run; defaults to all.")
+    parser.add_argument("--error_rate", type = float, default = 0.,
+            help = "Fraction of requests answered with an error (503).")
+    parser.add_argument("--retries", type = int, default = 0,
+            help = "Number of retries of the HTTP client on server errors (5xx).")
+    parser.add_argument("--extraction", action = "store_true", default = False,
+            help = "Also run the full extraction (prepare_stationdata.main; CPU bound, slow for large stores).")
+    parser.add_argument("--repeat", type = int, default = 1,
+            help = "Number of repetitions per scenario.")
+    args = parser.parse_args()
+
+    log.getLogger().setLevel(log.WARNING) # Silence the extraction
+    country, param = "germany", "t2m"
+
+    storage_options = None
+    if args.retries > 0:
+        storage_options = {"client_kwargs": {"middlewares": [retry_middleware(args.retries)]}}
+
+    root = tempfile.mkdtemp(prefix = "_mockserver_")
+    try:
+        make_eupp_store(root, country, param, nstations = args.stations, nsteps = args.steps, nyears = args.years)
+        res = []
+        for name, latency, bandwidth in SCENARIOS:
+            if args.scenario and not name in args.scenario: continue
+            for i in range(args.repeat):
+                res += run_scenario(root, name, latency, bandwidth, args.error_rate, country, param,
+                                    storage_options = storage_options, extraction = args.extraction)
+    finally:
+        shutil.rmtree(root)
+
+    print(f"\n{'scenario':10s} {'task':12s} {'seconds':>10s} {'requests':>10s} {'bytes':>14s} {'errors':>8s}  status")
+    for rec in res:
+        print(f"{rec['scenario']:10s} {rec['task']:12s} {rec['seconds']:10.2f} {rec['requests']:10d} {rec['bytes']:14d} {rec['errors']:8d}  {rec['status']}")
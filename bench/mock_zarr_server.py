@@ -0,0 +1,341 @@
+#!/usr/bin/env python3
+# -------------------------------------------------------------------
+# Local stand-in for the EUPP zarr storage (stations_data)
+#
+# Generates a small data set with the same layout as the EUPP
+# station zarr stores (consolidated metadata) and serves it over
+# HTTP. Latency, bandwidth and error rates can be injected, and
+# all requests/bytes are counted per key. Used by the benchmarks
+# in this folder to test the remote reading path of get_data
+# without network access.
+#
+# Authors: Thorsten Simon and Reto Stauffer
+# Date: 2022-09-16
+# -------------------------------------------------------------------
+
+import sys
+import os
+import re
+import time
+import random
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import logging as log
+log.basicConfig(level = log.INFO)
+
+# URL path under which the stores are served (same as on the EUPP storage)
+SERVER_PATH = "data/stations_data"
+
+# -------------------------------------------------------------------
+def make_eupp_store(root, country = "germany", param = "t2m", nstations = 5, ntimes = 104,
+                    nyears = 20, nsteps = 21, nmembers = 11, nafrac = 0.05, seed = 1):
+    """make_eupp_store(root, country = "germany", param = "t2m", ...)
+
+    Writes forecast and observation zarr stores (reforecasts and
+    forecasts) in the EUPP stations_data layout into `root/SERVER_PATH`.
+
+    Params
+    ------
+    root : str
+        Directory the data is written to, served as document root.
+    country : str
+        Country name used in the store names.
+    param : str
+        Name of the parameter.
+    nstations : int
+        Number of stations.
+    ntimes : int
+        Number of forecast dates (per year for reforecasts).
+    nyears : int
+        Number of reforecast years.
+    nsteps : int
+        Number of steps (6-hourly, starting at 0).
+    nmembers : int
+        Number of ensemble members (including control run).
+    nafrac : float
+        Fraction of observations set to missing.
+    seed : int
+        Seed for the random number generator.
+
+    Return
+    ------
+    str : Path of the directory containing the zarr stores.
+    """
+    import numpy as np
+    import pandas as pd
+    import xarray as xr
+
+    assert isinstance(root, str), TypeError("argument 'root' must be str")
+    for k in ["nstations", "ntimes", "nyears", "nsteps", "nmembers", "seed"]:
+        assert isinstance(locals()[k], int), TypeError(f"argument '{k}' must be int")
+    assert isinstance(nafrac, float), TypeError("argument 'nafrac' must be float")
+
+    rng = np.random.default_rng(seed)
+    target = os.path.join(root, SERVER_PATH)
+    if not os.path.isdir(target):
+        try: os.makedirs(target)
+        except Exception as e: raise Exception(e)
+
+    station_id = np.arange(1, nstations + 1) * 100
+    step       = pd.to_timedelta(np.arange(nsteps) * 6, unit = "h").values
+    fcs_meta   = {"model_altitude":   ("station_id", rng.uniform(0, 2000, nstations)),
+                  "model_land_usage": ("station_id", rng.integers(1, 30, nstations)),
+                  "model_latitude":   ("station_id", rng.uniform(45, 55, nstations)),
+                  "model_longitude":  ("station_id", rng.uniform(5, 15, nstations))}
+    obs_meta   = {"altitude":         ("station_id", rng.uniform(0, 2000, nstations)),
+                  "land_usage":       ("station_id", rng.integers(1, 30, nstations)),
+                  "latitude":         ("station_id", rng.uniform(45, 55, nstations)),
+                  "longitude":        ("station_id", rng.uniform(5, 15, nstations)),
+                  "station_name":     ("station_id", np.array([f"Station {x}" for x in station_id]))}
+
+    for reforecast in [True, False]:
+        ftype = "reforecasts" if reforecast else "forecasts"
+        if reforecast:
+            time_ = pd.date_range("2017-01-02", periods = ntimes, freq = "3.5D").floor("D").values
+            dims  = ["station_id", "time", "year", "step"]
+            coords = {"station_id": station_id, "time": time_, "year": np.arange(1, nyears + 1), "step": step}
+        else:
+            time_ = pd.date_range("2017-01-01", periods = ntimes, freq = "D").values
+            dims  = ["station_id", "time", "step"]
+            coords = {"station_id": station_id, "time": time_, "step": step}
+        shape = [len(coords[k]) for k in dims]
+
+        # Smooth seasonal cycle plus noise; members scatter around the 'truth'
+        yday  = pd.DatetimeIndex(time_).dayofyear.values
+        clim  = 283. - 10. * np.cos(2. * np.pi * yday / 365.25)
+        clim  = clim.reshape([1, -1] + [1] * (len(dims) - 2))
+        truth = clim + rng.normal(0, 3, shape)
+        obs   = truth + rng.normal(0, 1, shape)
+        obs[rng.uniform(size = shape) < nafrac] = np.nan
+        fcs   = truth[..., np.newaxis, np.newaxis] + rng.normal(0, 1.5, shape + [nmembers, 1])
+
+        obs = xr.Dataset({param: (dims, obs.astype("float32"))}, coords = {**coords, **obs_meta})
+        fcs = xr.Dataset({param: (dims + ["number", "surface"], fcs.astype("float32"))},
+                         coords = {**coords, **fcs_meta, "number": np.arange(nmembers), "surface": [0.0]})
+        # Same chunk/dimension order as the EUPP stores: number before the time dimensions
+        fcs = fcs.transpose("station_id", "number", *dims[1:], "surface")
+        for x in [obs, fcs]:
+            x.step.attrs["long_name"] = "time since forecast_reference_time"
+
+        obs.chunk({"station_id": 1}).to_zarr(os.path.join(target, f"stations_{ftype}_observations_surface_{country}.zarr"),
+                                             mode = "w", consolidated = True)
+        fcs.chunk({"station_id": 1}).to_zarr(os.path.join(target, f"stations_ensemble_{ftype}_surface_{country}.zarr"),
+                                             mode = "w", consolidated = True)
+        log.info(f"Written {ftype} stores for {country} into {target}")
+
+    return target
+
+
+# -------------------------------------------------------------------
+class MockZarrServer:
+    """MockZarrServer(root, host = "127.0.0.1", port = 0, latency = 0., bandwidth = None,
+                      error_rate = 0., seed = None)
+
+    Serves the files below `root` over HTTP (GET and HEAD, including
+    single byte ranges) in a background thread.
+
+    Params
+    ------
+    root : str
+        Document root, typically the directory used in `make_eupp_store`.
+    host : str
+        Host to bind to.
+    port : int
+        Port to bind to; 0 picks a free port.
+    latency : float
+        Seconds to wait before answering each request.
+    bandwidth : None or float
+        Maximum number of bytes per second per request; None for no limit.
+    error_rate : float
+        Probability (0-1) of answering a request with '503 Service Unavailable'.
+    seed : None or int
+        Seed for the error injection.
+
+    Attributes
+    ----------
+    url : str
+        Base URL to be used as `server_path` in `get_data`.
+    stats : dict
+        Number of requests, bytes sent and injected errors per key.
+    """
+
+    def __init__(self, root, host = "127.0.0.1", port = 0, latency = 0., bandwidth = None,
+                 error_rate = 0., seed = None):
+        assert isinstance(root, str), TypeError("argument 'root' must be str")
+        assert isinstance(latency, (int, float)) and latency >= 0, ValueError("argument 'latency' must be float >= 0")
+        assert isinstance(bandwidth, (int, float, type(None))), TypeError("argument 'bandwidth' must be None or float")
+        assert isinstance(error_rate, (int, float)) and 0 <= error_rate <= 1, ValueError("argument 'error_rate' must be in [0, 1]")
+        if not os.path.isdir(root): raise ValueError(f"directory '{root}' does not exist")
+
+        self.root       = os.path.abspath(root)
+        self.latency    = float(latency)
+        self.bandwidth  = None if bandwidth is None else float(bandwidth)
+        self.error_rate = float(error_rate)
+        self._rng       = random.Random(seed)
+        self._lock      = threading.Lock()
+        self._stats     = {}
+        self._httpd     = ThreadingHTTPServer((host, port), self._make_handler())
+        self._thread    = None
+
+    @property
+    def url(self):
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}/{SERVER_PATH}"
+
+    @property
+    def stats(self):
+        with self._lock:
+            return {k: dict(v) for k, v in self._stats.items()}
+
+    def reset_stats(self):
+        with self._lock:
+            self._stats = {}
+
+    def summary(self):
+        """summary()
+
+        Return
+        ------
+        dict : Total number of requests, bytes and injected errors.
+        """
+        stats = self.stats.values()
+        return {"requests": sum(x["requests"] for x in stats),
+                "bytes":    sum(x["bytes"] for x in stats),
+                "errors":   sum(x["errors"] for x in stats)}
+
+    def start(self):
+        self._thread = threading.Thread(target = self._httpd.serve_forever, daemon = True)
+        self._thread.start()
+        log.info(f"Mock zarr server running on {self.url}")
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+        if self._thread is not None: self._thread.join()
+        self._thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def _count(self, key, nbytes = 0, error = False):
+        with self._lock:
+            rec = self._stats.setdefault(key, {"requests": 0, "bytes": 0, "errors": 0})
+            rec["requests"] += 1
+            rec["bytes"]    += nbytes
+            rec["errors"]   += int(error)
+
+    def _inject_error(self):
+        with self._lock:
+            return self._rng.random() < self.error_rate
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True # Headers/body are written separately; avoids delayed ACKs
+
+            def log_message(self, *args):
+                pass # Silence default logging to stderr
+
+            def _respond(self, body):
+                key = self.path.split("?")[0].lstrip("/")
+                if server.latency > 0: time.sleep(server.latency)
+
+                if server._inject_error():
+                    server._count(key, error = True)
+                    self.send_error(503, "Injected error")
+                    return
+
+                # Resolve file; do not allow leaving the document root
+                file = os.path.abspath(os.path.join(server.root, key))
+                if not file.startswith(server.root + os.sep) or not os.path.isfile(file):
+                    server._count(key)
+                    self.send_error(404)
+                    return
+                size = os.path.getsize(file)
+
+                # Single byte range (bytes=a-b, bytes=a-, bytes=-n)
+                start, end = 0, size - 1
+                mtch = re.match(r"^bytes=(\d*)-(\d*)$", self.headers.get("Range", ""))
+                if mtch and any(mtch.groups()):
+                    if not mtch.group(1):
+                        start = max(0, size - int(mtch.group(2)))
+                    else:
+                        start = int(mtch.group(1))
+                        if mtch.group(2): end = min(end, int(mtch.group(2)))
+                    self.send_response(206)
+                    self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+                else:
+                    self.send_response(200)
+                length = max(0, end - start + 1)
+                self.send_header("Content-Type", "application/octet-stream")
+                self.send_header("Content-Length", str(length))
+                self.send_header("Accept-Ranges", "bytes")
+                self.end_headers()
+
+                if not body:
+                    server._count(key)
+                    return
+                with open(file, "rb") as fid:
+                    fid.seek(start)
+                    data = fid.read(length)
+                # Send in blocks to be able to throttle the bandwidth
+                blocksize = 64 * 1024
+                for i in range(0, len(data), blocksize):
+                    block = data[i:(i + blocksize)]
+                    self.wfile.write(block)
+                    if server.bandwidth: time.sleep(len(block) / server.bandwidth)
+                server._count(key, len(data))
+
+            def do_GET(self):
+                self._respond(body = True)
+
+            def do_HEAD(self):
+                self._respond(body = False)
+
+        return Handler
+
+
+# -------------------------------------------------------------------
+# Main part of the Script
+# -------------------------------------------------------------------
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(f"{sys.argv[0]}")
+    parser.add_argument("-r", "--root", type = str, default = "_mockserver",
+            help = "Document root of the server; data is generated there if not existing.")
+    parser.add_argument("-c", "--country", type = str.lower, default = "germany",
+            help = "Name of the country used for the generated stores.")
+    parser.add_argument("-p", "--param", type = str.lower, default = "t2m",
+            help = "Name of the parameter used for the generated stores.")
+    parser.add_argument("--port", type = int, default = 8080,
+            help = "Port to listen on.")
+    parser.add_argument("--latency", type = float, default = 0.,
+            help = "Latency in seconds added to each request.")
+    parser.add_argument("--bandwidth", type = float, default = None,
+            help = "Bandwidth limit per request in bytes per second.")
+    parser.add_argument("--error_rate", type = float, default = 0.,
+            help = "Fraction of requests answered with an error (503).")
+    args = parser.parse_args()
+
+    if not os.path.isdir(os.path.join(args.root, SERVER_PATH)):
+        make_eupp_store(args.root, args.country, args.param)
+
+    server = MockZarrServer(args.root, port = args.port, latency = args.latency,
+                            bandwidth = args.bandwidth, error_rate = args.error_rate)
+    print(f"Use as server path: {server.url}")
+    try:
+        server.start()
+        while True: time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()
+        for k, v in sorted(server.stats.items()): print(f"{k:100s} {v}")
@@ -2,7 +2,11 @@
 
 
 from .get_data import get_data
+from .create_zip import create_zip
 from .get_csv_filename import get_csv_filename
 from .get_data import get_data
+from .get_data_quality import get_data_quality
 from .get_station_meta import get_station_meta
 from .modify_date import modify_date
+from .shard import parse_shard, plan_shards, get_shard_filename
+from .seasonal_emos import fit_seasonal_emos, predict_seasonal_emos, sweep_seasonal_emos
@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+# -------------------------------------------------------------------
+# Authors: Thorsten Simon and Reto Stauffer
+# Date: 2022-09-16
+# -------------------------------------------------------------------
+
+import os
+from zipfile import ZipFile
+import logging as log
+log.basicConfig(level = log.INFO)
+
+# -------------------------------------------------------------------
+def create_zip(final_zip, files):
+    """create_zip(final_zip, files)
+
+    Stores the files (by basename) in a zip file and deletes the source
+    files if the zip file has been created successfully.
+
+    Params
+    ------
+    final_zip : str
+        Name of the zip file to be created.
+    files : list
+        List of files (str) to be stored.
+
+    Return
+    ------
+    bool : True if the zip file has been created, else False.
+    """
+    assert isinstance(final_zip, str), TypeError("argument 'final_zip' must be str")
+    assert isinstance(files, list), TypeError("argument 'files' must be list")
+
+    files = sorted(files, key = os.path.basename)
+    try:
+        with ZipFile(final_zip, "w") as fid:
+            for f in files:
+                fid.write(f, arcname = os.path.basename(f)) # Store in zip
+    except Exception as e:
+        log.error(f"Problems with zipping ({e}), do not delete files")
+        if os.path.isfile(final_zip): os.remove(final_zip)
+        return False
+
+    log.info("Zip file created, delete source files")
+    for f in files: os.remove(f)
+    return True
@@ -7,6 +7,8 @@
 import sys
 import os
 import pickle
+import hashlib
+import tempfile
 import fsspec
 import xarray as xr
 
@@ -14,32 +16,46 @@ import logging as log
 log.basicConfig(level = log.INFO)
 
 # -------------------------------------------------------------------
-def get_data(country, param, reforecast, cachedir = "_cache", do_cache = True):
+def get_data(country, param, reforecast, cachedir = "_cache", do_cache = True, server_path = None,
+             storage_options = None):
     """get_data(cachefile)
 
     ... [tbd]
+
+    If `server_path` (str) is set it is used instead of the EUPP storage
+    (e.g., a local mock server, see `bench/mock_zarr_server.py`); the
+    cache file name then contains a hash of it, so data from different
+    servers is never mixed up. `storage_options` (dict) are passed on to the fsspec file system,
+    e.g., `client_kwargs` or `get_client` for the HTTP client.
     """
     assert isinstance(country, str), TypeError("argument 'country' must be string")
     assert isinstance(param, str), TypeError("argument 'param' must be string")
     assert isinstance(reforecast, bool), TypeError("argument 'reforecast' must be bool")
+    assert isinstance(server_path, (str, type(None))), TypeError("argument 'server_path' must be None or str")
+    assert isinstance(storage_options, (dict, type(None))), TypeError("argument 'storage_options' must be None or dict")
+    if storage_options is None: storage_options = {}
 
     # Forecast type
     ftype = "reforecasts" if reforecast else "forecasts"
 
     # If we have caching on, make sure the output dir exists and generate output name
-    cachefile = os.path.join(cachedir, f"_cached_{country.lower()}_{param}_{ftype}.pickle")
+    # (with the hash of the alternative server, if any)
+    server = "" if server_path is None else "_" + hashlib.md5(server_path.rstrip("/").encode()).hexdigest()[:8]
+    cachefile = os.path.join(cachedir, f"_cached_{country.lower()}_{param}_{ftype}{server}.pickle")
     if do_cache:
         if not os.path.isdir(cachedir):
             print(f"Creating cache directory '{cachedir}'")
             try:
-                os.makedirs(cachedir)
+                os.makedirs(cachedir, exist_ok = True) # May be created by a parallel process
             except Exception as e:
                 raise Exception(e)
         print(f"Cachefile: {cachefile}")
 
     # If the country is 'swtizerland' this is in the restrictec area and only
     # available via EWC (cloud)
-    if country in ["switzerland"]:
+    if server_path is not None:
+        server_path = server_path.rstrip("/")
+    elif country in ["switzerland"]:
         server_path = "/mnt/benchmark-training-dataset-zarr-restricted/mnt/benchmark-training-dataset-zarr-restricted/data/stations_data"
     else:
         server_path = "https://storage.ecmwf.europeanweather.cloud/eumetnet-postprocessing-benchmark-1st-phase-training-dataset/data/stations_data"
@@ -54,7 +70,7 @@ def get_data(country, param, reforecast, cachedir = "_cache", do_cache = True):
         # Reading forecasts
         target_file = f"{server_path}/stations_ensemble_{ftype}_surface_{country.lower()}.zarr"
         log.info(f"Reading: {target_file}")
-        target_fcs = fsspec.get_mapper(target_file)
+        target_fcs = fsspec.get_mapper(target_file, **storage_options)
         del target_file
         fcs = xr.open_zarr(target_fcs, consolidated = True)[[param]]
         fcs_vars = fcs.var().variables
@@ -62,7 +78,7 @@ def get_data(country, param, reforecast, cachedir = "_cache", do_cache = True):
         # Reading observations
         target_file = f"{server_path}/stations_{ftype}_observations_surface_{country.lower()}.zarr"
         log.info(f"Reading: {target_file}")
-        target_obs = fsspec.get_mapper(target_file)
+        target_obs = fsspec.get_mapper(target_file, **storage_options)
         del target_file
         obs = xr.open_zarr(target_obs, consolidated = True)[[param]]
         obs_vars = obs.var().variables
@@ -72,10 +88,18 @@ def get_data(country, param, reforecast, cachedir = "_cache", do_cache = True):
         obs = obs[[param]]
         fcs = fcs[[param]]
 
+        # Written to a temporary file first and moved into place, so that
+        # parallel processes (e.g., shards) never read an incomplete file
         if do_cache:
-            with open(cachefile, "wb") as fid:
-                log.info(f"Saving data into {cachefile}")
-                pickle.dump([fcs, obs], fid)
+            log.info(f"Saving data into {cachefile}")
+            fd, tmpfile = tempfile.mkstemp(dir = cachedir, prefix = os.path.basename(cachefile) + ".")
+            try:
+                with os.fdopen(fd, "wb") as fid:
+                    pickle.dump([fcs, obs], fid)
+                os.replace(tmpfile, cachefile)
+            except Exception as e:
+                if os.path.isfile(tmpfile): os.remove(tmpfile)
+                raise Exception(e)
 
     # Read prepared data from pickle file
     if do_cache:
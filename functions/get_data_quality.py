@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+# -------------------------------------------------------------------
+# Authors: Thorsten Simon and Reto Stauffer
+# Date: 2022-09-16
+# -------------------------------------------------------------------
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+import logging as log
+log.basicConfig(level = log.INFO)
+
+# -------------------------------------------------------------------
+def get_data_quality(fcs, obs, param, years = [9999, 3], na_limit = 0.2, min_per_bin = 60, binwidth = 30):
+    """get_data_quality(fcs, obs, param, years = [9999, 3], na_limit = 0.2, min_per_bin = 60, binwidth = 30)
+
+    Computes the missing-data rule used by `jobs/crch_run.R` and
+    `jobs/bamlss_run.R` for all stations and steps at once. A row is
+    missing if the observation is missing or the ensemble mean/standard
+    deviation cannot be calculated (less than two members available).
+    If more than `na_limit` of all rows are missing, a station/step
+    is only fittable if each `binwidth`-day yday bin (as `cut(yday,
+    breaks = seq(0, 366, by = 30))` in R) contains at least `min_per_bin`
+    complete rows.
+
+    The rule is evaluated for each training window in `years` as the
+    R jobs apply it after cutting the training data set (`-y`), i.e.
+    on all rows whose valid time plus step falls into the last `years`
+    years up to 2017. Windows of 100 years or more use all rows.
+
+    Params
+    ------
+    fcs : xarray.core.dataset.Dataset
+        Object which contains the station-based forecasts (all stations, ...).
+    obs : xarray.core.dataset.Dataset
+        Object which contains the station-based observations (all stations, ...).
+    param : str
+        Name of the parameter to be checked.
+    years : list
+        Training window lengths (int, years) as used with `-y` in the R jobs.
+    na_limit : float
+        Fraction of missing rows above which the yday bins are checked.
+    min_per_bin : int
+        Minimum number of complete rows per yday bin.
+    binwidth : int
+        Width of the yday bins in days.
+
+    Return
+    ------
+    pandas.core.frame.DataFrame : One row per training window (years), station
+    and step (in hours) with the number of rows, number of rows with missing values, the fraction of
+    missing rows, complete rows per yday bin, and a boolean column 'fittable'.
+    """
+
+    from xarray.core.dataset import Dataset
+    assert isinstance(fcs, Dataset), TypeError("argument 'fcs' must be an xarray Dataset")
+    assert isinstance(obs, Dataset), TypeError("argument 'obs' must be an xarray Dataset")
+    assert isinstance(param, str), TypeError("argument 'param' must be string")
+    assert isinstance(years, list), TypeError("argument 'years' must be list")
+    assert all(isinstance(x, int) and x > 0 for x in years), ValueError("elements of 'years' must be positive int")
+    assert isinstance(na_limit, float), TypeError("argument 'na_limit' must be float")
+    assert isinstance(min_per_bin, int), TypeError("argument 'min_per_bin' must be int")
+    assert isinstance(binwidth, int), TypeError("argument 'binwidth' must be int")
+
+    if not param in fcs.variables: raise ValueError(f"cannot find '{param}' in fcs")
+    if not param in obs.variables: raise ValueError(f"cannot find '{param}' in obs")
+
+    fcs_param = fcs[param]
+    obs_param = obs[param]
+    if "surface" in fcs_param.dims: fcs_param = fcs_param.sel(surface = 0.0)
+    if "surface" in obs_param.dims: obs_param = obs_param.sel(surface = 0.0)
+
+    # Row is missing if the observation is missing or if ens_mean/ens_sd
+    # end up missing (pandas std needs at least two members).
+    log.info("Flagging rows with missing values")
+    # Loaded once (one pass over the data); all windows are derived from it.
+    na = obs_param.isnull() | (fcs_param.count("number") < 2)
+    na = na.reset_coords(drop = True).load()
+
+    # Dimensions which make up the rows of one station/step data set
+    rowdims = [x for x in na.dims if not x in ["station_id", "step"]]
+
+    # -----------------------------------
+    # yday of the valid time (0-based) on the (time, [year,] step) grid,
+    # shifting reforecasts back in time the same way as modify_date does;
+    # year of valid time plus step for the training windows.
+    log.info("Calculating yday of valid times")
+    times = pd.DatetimeIndex(na.coords["time"].values)
+    steps = na.coords["step"].values
+    if "year" in na.dims:
+        nyears = len(na.coords["year"])
+        yday   = []
+        for year in na.coords["year"].values:
+            vtime = (times - pd.DateOffset(years = int(nyears - year + 1))).values
+            yday.append(vtime[:, None] + steps[None, :])
+        yday = np.stack(yday, axis = 1)
+        ydims = ["time", "year", "step"]
+    else:
+        yday  = times.values[:, None] + steps[None, :]
+        ydims = ["time", "step"]
+    vyear = pd.DatetimeIndex((yday + steps).ravel()).year.values.reshape(yday.shape)
+    yday  = pd.DatetimeIndex(yday.ravel()).dayofyear.values.reshape(yday.shape) - 1
+    yday  = xr.DataArray(yday, dims = ydims, coords = {k: na.coords[k] for k in ydims})
+    vyear = xr.DataArray(vyear, dims = ydims, coords = {k: na.coords[k] for k in ydims})
+
+    # Bins as cut(yday, breaks = seq(0, 366, by = binwidth)), right closed;
+    # yday outside the breaks is not counted at all.
+    nbins = 366 // binwidth
+    ybin  = xr.where((yday > 0) & (yday <= nbins * binwidth), np.ceil(yday / binwidth) - 1, -1)
+
+    # -----------------------------------
+    # Counting; one reduction over all rows for all stations and steps
+    # per training window
+    complete = ~na
+    bins = [f"yday_bin_{i + 1:02d}" for i in range(nbins)]
+    res  = []
+    for y in sorted(set(years), reverse = True):
+        log.info(f"Counting missing values and complete rows per yday bin ({y} years)")
+        inwin = vyear >= (2017 + 1 - y) if y < 100 else xr.full_like(vyear, True, dtype = bool)
+        tmp   = {"nrow": inwin.sum(rowdims), "n_na": (na & inwin).sum(rowdims)}
+        for i in range(nbins):
+            tmp[bins[i]] = (complete & inwin & (ybin == i)).sum(rowdims)
+        tmp = xr.Dataset(tmp).transpose("station_id", "step")
+        tmp = tmp.to_dataframe(dim_order = ["station_id", "step"]).reset_index()
+        tmp.insert(0, "years", y)
+        res.append(tmp)
+    res = pd.concat(res, ignore_index = True)
+
+    res["step"]     = (res.step / np.timedelta64(1, "h")).astype(int)
+    res["na_frac"]  = res.n_na / res.nrow
+    res["fittable"] = (res.nrow > res.n_na) & \
+                      (~(res.n_na > res.nrow * na_limit) | (res[bins] >= min_per_bin).all(axis = 1))
+
+    log.info(f"- Finished, {(~res.fittable).sum()} of {len(res)} station/steps not fittable")
+    return res[["years", "station_id", "step", "nrow", "n_na", "na_frac"] + bins + ["fittable"]]
+
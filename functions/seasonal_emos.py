@@ -0,0 +1,373 @@
+#!/usr/bin/env python3
+# -------------------------------------------------------------------
+# Authors: Thorsten Simon and Reto Stauffer
+# Date: 2022-09-16
+# -------------------------------------------------------------------
+
+import numpy as np
+from functools import lru_cache
+import logging as log
+log.basicConfig(level = log.INFO)
+
+# -------------------------------------------------------------------
+def cyclic_bspline_basis(x, nknots = 10, period = 366.):
+    """cyclic_bspline_basis(x, nknots = 10, period = 366.)
+
+    Cyclic cubic B-spline basis on equidistant knots; the basis
+    functions sum up to one for each x (includes the intercept).
+
+    Params
+    ------
+    x : numpy.ndarray
+        Values (e.g., yday) the basis is evaluated at; any shape.
+    nknots : int
+        Number of knots/basis functions, at least 4.
+    period : float
+        Length of the cycle.
+
+    Return
+    ------
+    numpy.ndarray : Array of shape x.shape + (nknots,).
+    """
+    assert isinstance(nknots, int) and nknots >= 4, ValueError("argument 'nknots' must be int >= 4")
+    assert isinstance(period, float), TypeError("argument 'period' must be float")
+
+    x = np.asarray(x, dtype = float)
+    u = np.mod(x[..., np.newaxis] / (period / nknots) - np.arange(nknots), nknots)
+
+    # Cardinal cubic B-spline with support [0, 4)
+    return np.select([u < 1, u < 2, u < 3, u < 4],
+                     [u**3 / 6.,
+                      (-3. * u**3 + 12. * u**2 - 12. * u + 4.) / 6.,
+                      (3. * u**3 - 24. * u**2 + 60. * u - 44.) / 6.,
+                      (4. - u)**3 / 6.], default = 0.)
+
+
+# -------------------------------------------------------------------
+def cyclic_penalty(nknots):
+    """cyclic_penalty(nknots)
+
+    Cyclic second-order difference penalty; constants are not penalized.
+
+    Params
+    ------
+    nknots : int
+        Number of basis functions.
+
+    Return
+    ------
+    numpy.ndarray : Penalty matrix of shape (nknots, nknots).
+    """
+    assert isinstance(nknots, int), TypeError("argument 'nknots' must be int")
+    D = np.zeros((nknots, nknots))
+    for i in range(nknots):
+        D[i, [i, (i + 1) % nknots, (i + 2) % nknots]] += [1., -2., 1.]
+    return D.T @ D
+
+
+# -------------------------------------------------------------------
+@lru_cache(maxsize = 8)
+def _basis_table(nknots, period):
+    """Basis evaluated once for all integer yday in [0, period)."""
+    B = cyclic_bspline_basis(np.arange(int(np.ceil(period)), dtype = float), nknots, period)
+    B.flags.writeable = False
+    return B
+
+
+def _basis(yday, nknots, period):
+    """Basis for yday (missing values set to zero); looked up from
+    _basis_table for integer yday, evaluated otherwise."""
+    yday = np.where(np.isfinite(yday), yday, 0.)
+    B    = _basis_table(nknots, period)
+    if np.all((yday == np.floor(yday)) & (yday >= 0) & (yday < len(B))):
+        return B[yday.astype(int)]
+    return cyclic_bspline_basis(yday, nknots, period)
+
+
+def _design(B, x):
+    """Design matrix for s(yday, bs = "cc") + s(yday, bs = "cc", by = x), B = _basis(yday)."""
+    return np.concatenate([B, B * x[..., np.newaxis]], axis = -1)
+
+
+# -------------------------------------------------------------------
+def fit_seasonal_emos(y, yday, ens_mean, log_ens_sd, nknots = 10, period = 366., lam = (10., 10.),
+                      maxit = 100, tol = 1e-8, start = None):
+    """fit_seasonal_emos(y, yday, ens_mean, log_ens_sd, nknots = 10, period = 366., lam = (10., 10.), ...)
+
+    Penalized maximum likelihood version of the bamlss model in `jobs/bamlss_run.R`,
+
+        mu:          y ~ s(yday, bs = "cc") + s(yday, bs = "cc", by = ens_mean)
+        log(sigma):    ~ s(yday, bs = "cc") + s(yday, bs = "cc", by = log_ens_sd)
+
+    fitted for a batch of independent groups (station/step) at once.
+    All inputs are arrays of shape (groups, rows); rows with any missing
+    value are ignored (use NaN for padding). The smoothing parameters
+    `lam` are fixed, and all groups are updated simultaneously by
+    Fisher scoring with step halving. Groups with no more observations
+    than coefficients per parameter (2 * nknots), or for which the
+    scoring fails numerically, are not fitted.
+
+    Params
+    ------
+    y, yday, ens_mean, log_ens_sd : numpy.ndarray
+        Observations and covariates, all of shape (groups, rows).
+    nknots : int
+        Number of cyclic B-spline basis functions per smooth term.
+    period : float
+        Length of the yday cycle.
+    lam : tuple
+        Smoothing parameters (location, scale).
+    maxit : int
+        Maximum number of iterations.
+    tol : float
+        Relative convergence tolerance on the penalized log-likelihood.
+    start : None or dict
+        Starting values (coefficients 'beta' and 'gamma', e.g. from a
+        previous fit). Groups with missing starting values use defaults.
+
+    Return
+    ------
+    dict : Coefficients 'beta' (location) and 'gamma' (log scale) of shape
+    (groups, 2 * nknots), 'loglik' (unpenalized), 'nobs', 'converged',
+    and the basis settings 'nknots' and 'period'. Groups not fitted get
+    NaN coefficients and 'converged' False.
+    """
+    assert isinstance(lam, (tuple, list)) and len(lam) == 2, ValueError("argument 'lam' must be a tuple of length 2")
+    assert isinstance(start, (dict, type(None))), TypeError("argument 'start' must be None or dict")
+
+    y, ens_mean, w, X, Z = _prepare(y, yday, ens_mean, log_ens_sd, nknots, period)
+    Sb, Sg = _penalty(nknots, lam)
+    nobs   = w.sum(axis = 1)
+
+    beta, gamma = _default_start(np.sum(w * (y - ens_mean)**2, axis = 1), nobs, nknots)
+    if start is not None: _apply_start(beta, gamma, start)
+
+    # Fisher information of the scale part does not depend on the coefficients
+    Fg = 2. * np.swapaxes(Z * w[..., np.newaxis], 1, 2) @ Z + Sg
+
+    beta, gamma, ll, converged, it = _scoring(X, Z, y, w, Sb, Sg, Fg, beta, gamma, maxit, tol)
+    log.info(f"Seasonal EMOS: {np.sum(converged)} of {len(y)} groups converged after {it} iterations")
+    return {"beta": beta, "gamma": gamma, "loglik": ll, "nobs": nobs.astype(int),
+            "converged": converged, "nknots": nknots, "period": period}
+
+
+# -------------------------------------------------------------------
+def sweep_seasonal_emos(y, yday, ens_mean, log_ens_sd, age, windows, nknots = 10, period = 366.,
+                        lam = (10., 10.), maxit = 100, tol = 1e-8, mask = None):
+    """sweep_seasonal_emos(y, yday, ens_mean, log_ens_sd, age, windows, nknots = 10, ..., mask = None)
+
+    Fits the model of fit_seasonal_emos for a series of training windows
+    (e.g., the last 1, 3, ..., all years). Each window contains all rows with
+    `age < window`. The windows are processed from newest to oldest. The design
+    matrices are set up once, and the statistics which do not depend on the
+    coefficients are accumulated over the age blocks. Each fit is
+    warm-started from the previous (shorter) window.
+
+    Params
+    ------
+    y, yday, ens_mean, log_ens_sd : numpy.ndarray
+        Observations and covariates, all of shape (groups, rows).
+    age : numpy.ndarray
+        Age of each row (e.g., years before the end of the training period,
+        0 for the most recent), shape (groups, rows).
+    windows : list
+        Window lengths (positive int) in increasing order.
+    nknots, period, lam, maxit, tol :
+        See fit_seasonal_emos.
+    mask : None or numpy.ndarray
+        Boolean of shape (groups, windows); groups are only fitted for
+        the windows where mask is True (e.g., missing-data rule).
+
+    Return
+    ------
+    list : One object as returned by fit_seasonal_emos for each window.
+    """
+    assert isinstance(windows, (list, tuple)) and len(windows) > 0, ValueError("argument 'windows' must be a non-empty list")
+    assert all(isinstance(x, int) and x > 0 for x in windows), ValueError("argument 'windows' must contain positive int")
+    assert list(windows) == sorted(set(windows)), ValueError("argument 'windows' must be increasing")
+    assert isinstance(lam, (tuple, list)) and len(lam) == 2, ValueError("argument 'lam' must be a tuple of length 2")
+
+    y, ens_mean, w, X, Z = _prepare(y, yday, ens_mean, log_ens_sd, nknots, period)
+    mask = np.ones((len(y), len(windows)), dtype = bool) if mask is None else np.asarray(mask, dtype = bool)
+    assert mask.shape == (len(y), len(windows)), ValueError("argument 'mask' must be of shape (groups, windows)")
+    age = np.asarray(age, dtype = float).reshape(y.shape)
+    w   = np.where(np.isfinite(age), w, 0.)
+    age = np.where(np.isfinite(age), age, 0.).astype(int).clip(0)
+    Sb, Sg = _penalty(nknots, lam)
+
+    # Sorting rows by age; each window is then a leading block of columns
+    idx = np.argsort(age, axis = 1, kind = "stable")
+    y, w, age = [np.take_along_axis(x, idx, axis = 1) for x in [y, w, age]]
+    ens_mean  = np.take_along_axis(ens_mean, idx, axis = 1)
+    X, Z      = [np.take_along_axis(x, idx[..., np.newaxis], axis = 1) for x in [X, Z]]
+
+    # Cumulative statistics; age blocks are added as the window grows
+    Zw   = Z * w[..., np.newaxis]
+    r2   = w * (y - ens_mean)**2
+    cumF = np.zeros((len(y), 2 * nknots, 2 * nknots))
+    cumn = np.zeros(len(y))
+    cumr = np.zeros(len(y))
+    a, amax = 0, age.max(initial = 0)
+
+    res = []
+    for j, window in enumerate(windows):
+        while a < window and a <= amax:
+            idx   = age == a
+            cumF += 2. * np.swapaxes(Zw * idx[..., np.newaxis], 1, 2) @ Z
+            cumn += np.sum(w * idx, axis = 1)
+            cumr += np.sum(r2 * idx, axis = 1)
+            a    += 1
+
+        beta, gamma = _default_start(cumr, cumn, nknots)
+        if len(res) > 0: _apply_start(beta, gamma, res[-1])
+
+        n  = np.max(np.sum(age < window, axis = 1))
+        ww = w * (age < window) * mask[:, j, np.newaxis]
+        beta, gamma, ll, converged, it = _scoring(X[:, :n], Z[:, :n], y[:, :n], ww[:, :n],
+                                                  Sb, Sg, cumF + Sg, beta, gamma, maxit, tol)
+        log.info(f"Seasonal EMOS, window {window}: {np.sum(converged)} of {len(y)} groups converged after {it} iterations")
+        res.append({"beta": beta, "gamma": gamma, "loglik": ll, "nobs": cumn.astype(int),
+                    "converged": converged, "nknots": nknots, "period": period})
+    return res
+
+
+# -------------------------------------------------------------------
+def _prepare(y, yday, ens_mean, log_ens_sd, nknots, period):
+    """Weights (0/1) and design matrices; missing rows are set to zero."""
+    y, yday, ens_mean, log_ens_sd = [np.atleast_2d(np.asarray(x, dtype = float)) for x in [y, yday, ens_mean, log_ens_sd]]
+    assert y.shape == yday.shape == ens_mean.shape == log_ens_sd.shape, ValueError("inputs must be of identical shape")
+
+    w = np.isfinite(y) & np.isfinite(yday) & np.isfinite(ens_mean) & np.isfinite(log_ens_sd)
+    y, yday, ens_mean, log_ens_sd = [np.where(w, x, 0.) for x in [y, yday, ens_mean, log_ens_sd]]
+    B = _basis(yday, nknots, period)
+    X = _design(B, ens_mean)
+    Z = _design(B, log_ens_sd)
+    return y, ens_mean, w.astype(float), X, Z
+
+
+def _penalty(nknots, lam):
+    """Penalty matrices for location and scale coefficients."""
+    S = np.kron(np.eye(2), cyclic_penalty(nknots)) + 1e-8 * np.eye(2 * nknots)
+    return lam[0] * S, lam[1] * S
+
+
+def _default_start(ssr, nobs, nknots):
+    """Starting values mu = ens_mean and constant sigma from the residual sum of squares."""
+    beta  = np.repeat(np.concatenate([np.zeros(nknots), np.ones(nknots)])[np.newaxis], len(nobs), axis = 0)
+    sd    = np.sqrt(ssr / np.maximum(nobs, 1))
+    gamma = np.zeros_like(beta)
+    gamma[:, :nknots] = np.log(np.where(sd > 0, sd, 1.))[:, np.newaxis]
+    return beta, gamma
+
+
+def _apply_start(beta, gamma, start):
+    """Overwrites starting values (in place) where 'start' has finite coefficients."""
+    idx = np.all(np.isfinite(start["beta"]), axis = 1) & np.all(np.isfinite(start["gamma"]), axis = 1)
+    beta[idx], gamma[idx] = start["beta"][idx], start["gamma"][idx]
+
+
+def _solve(F, g):
+    """Batched solve of F d = g; NaN for groups with non-finite or singular systems."""
+    d   = np.full(g.shape, np.nan)
+    idx = np.flatnonzero(np.all(np.isfinite(F), axis = (1, 2)) & np.all(np.isfinite(g), axis = 1))
+    try:
+        d[idx] = np.linalg.solve(F[idx], g[idx, :, np.newaxis])[..., 0]
+    except np.linalg.LinAlgError:
+        for i in idx:
+            try: d[i] = np.linalg.solve(F[i], g[i])
+            except np.linalg.LinAlgError: pass
+    return d
+
+
+def _scoring(X, Z, y, w, Sb, Sg, Fg, beta, gamma, maxit, tol):
+    """Fisher scoring with step halving; Fg is the (constant) penalized
+    Fisher information of the scale coefficients. Each iteration only
+    involves the groups which have not yet converged. Groups with too
+    few observations (not more than coefficients per parameter) are
+    skipped, groups where scoring fails numerically are dropped."""
+    def loglik(X, Z, y, w, beta, gamma):
+        eta = np.einsum("gnp,gp->gn", Z, gamma)
+        res = (y - np.einsum("gnp,gp->gn", X, beta)) * np.exp(-eta)
+        ll  = np.sum(w * (-eta - 0.5 * res**2 - 0.5 * np.log(2. * np.pi)), axis = 1)
+        pen = 0.5 * (np.einsum("gp,pq,gq->g", beta, Sb, beta) + np.einsum("gp,pq,gq->g", gamma, Sg, gamma))
+        return ll, ll - pen
+
+    beta, gamma = beta.copy(), gamma.copy()
+    ok        = w.sum(axis = 1) > X.shape[-1]
+    w         = np.where(ok[:, np.newaxis], w, 0.)
+    ll, pll   = loglik(X, Z, y, w, beta, gamma)
+    converged = ~ok
+    it        = 0
+    while it < maxit and not np.all(converged):
+        it += 1
+        act = np.flatnonzero(~converged)
+        Xa, Za, ya, wa = X[act], Z[act], y[act], w[act]
+        ba, ga = beta[act], gamma[act]
+
+        with np.errstate(over = "ignore", invalid = "ignore"):
+            eta   = np.einsum("gnp,gp->gn", Za, ga)
+            isig2 = wa * np.exp(-2. * eta)
+            res   = ya - np.einsum("gnp,gp->gn", Xa, ba)
+
+            # Scores and Fisher information (block diagonal for location/log-scale)
+            gb = np.einsum("gnp,gn->gp", Xa, isig2 * res) - ba @ Sb
+            gg = np.einsum("gnp,gn->gp", Za, isig2 * res**2 - wa) - ga @ Sg
+            Fb = np.swapaxes(Xa * isig2[..., np.newaxis], 1, 2) @ Xa + Sb
+        db = _solve(Fb, gb)
+        dg = _solve(Fg[act], gg)
+
+        # Numerical failure (e.g., scale collapsing to zero); drop these groups
+        fail = ~(np.all(np.isfinite(db), axis = 1) & np.all(np.isfinite(dg), axis = 1))
+        if np.any(fail):
+            ok[act[fail]], converged[act[fail]] = False, True
+            db[fail], dg[fail] = 0., 0.
+
+        # Step halving for groups where the penalized log-likelihood decreases
+        step = np.ones(len(act))
+        for i in range(30):
+            with np.errstate(over = "ignore", invalid = "ignore"):
+                new_ll, new_pll = loglik(Xa, Za, ya, wa, ba + step[:, np.newaxis] * db, ga + step[:, np.newaxis] * dg)
+            bad = ~(new_pll >= pll[act] - 1e-10 * np.abs(pll[act]))
+            if not np.any(bad): break
+            step[bad] *= 0.5
+        # No improvement found; keep the current coefficients
+        step[bad] = 0.
+        new_ll  = np.where(bad, ll[act], new_ll)
+        new_pll = np.where(bad, pll[act], new_pll)
+
+        beta[act]  = ba + step[:, np.newaxis] * db
+        gamma[act] = ga + step[:, np.newaxis] * dg
+        converged[act] = fail | (np.abs(new_pll - pll[act]) <= tol * (np.abs(pll[act]) + tol))
+        ll[act], pll[act] = new_ll, new_pll
+
+    # Groups not fitted (too few observations, numerical failure)
+    beta[~ok], gamma[~ok], ll[~ok] = np.nan, np.nan, np.nan
+    return beta, gamma, ll, converged & ok, it
+
+
+# -------------------------------------------------------------------
+def predict_seasonal_emos(coef, yday, ens_mean, log_ens_sd):
+    """predict_seasonal_emos(coef, yday, ens_mean, log_ens_sd)
+
+    Params
+    ------
+    coef : dict
+        Object as returned by fit_seasonal_emos.
+    yday, ens_mean, log_ens_sd : numpy.ndarray
+        Covariates of shape (groups, rows).
+
+    Return
+    ------
+    tuple : Location and scale, each of shape (groups, rows); NaN where
+    covariates are missing.
+    """
+    assert isinstance(coef, dict), TypeError("argument 'coef' must be dict")
+    yday, ens_mean, log_ens_sd = [np.atleast_2d(np.asarray(x, dtype = float)) for x in [yday, ens_mean, log_ens_sd]]
+
+    na = ~(np.isfinite(yday) & np.isfinite(ens_mean) & np.isfinite(log_ens_sd))
+    B  = _basis(yday, coef["nknots"], coef["period"])
+    X  = _design(B, np.where(na, 0., ens_mean))
+    Z  = _design(B, np.where(na, 0., log_ens_sd))
+    location = np.where(na, np.nan, np.einsum("gnp,gp->gn", X, coef["beta"]))
+    scale    = np.where(na, np.nan, np.exp(np.einsum("gnp,gp->gn", Z, coef["gamma"])))
+    return location, scale
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+# -------------------------------------------------------------------
+# Authors: Thorsten Simon and Reto Stauffer
+# Date: 2022-09-16
+# -------------------------------------------------------------------
+
+import os
+import re
+import heapq
+import numpy as np
+import pandas as pd
+import logging as log
+log.basicConfig(level = log.INFO)
+
+# -------------------------------------------------------------------
+def parse_shard(shard):
+    """parse_shard(shard)
+
+    Params
+    ------
+    shard : str
+        Shard specification 'i/N' with 1 <= i <= N.
+
+    Return
+    ------
+    tuple : Shard index i and number of shards N (both int).
+    """
+    assert isinstance(shard, str), TypeError("argument 'shard' must be str")
+    mtch = re.match(r"^\s*([0-9]+)\s*/\s*([0-9]+)\s*$", shard)
+    if not mtch: raise ValueError(f"shard '{shard}' not of form 'i/N'")
+    i, n = int(mtch.group(1)), int(mtch.group(2))
+    if not 1 <= i <= n: raise ValueError(f"shard '{shard}' invalid, requires 1 <= i <= N")
+    return i, n
+
+
+# -------------------------------------------------------------------
+def get_shard_filename(args, shard, nshards, part = None):
+    """get_shard_filename(args, shard, nshards, part = None)
+
+    Return
+    ------
+    str : Name of the manifest file written by shard 'shard' of 'nshards',
+    or of the partial table 'part' (e.g., 'quality') of this shard.
+    Does not match the pattern of the files stored in the final zip file.
+    """
+    part = "" if part is None else f"_{part}"
+    return os.path.join(args.prefix, f"shard_{args.prefix}_{args.param}_{args.country}{part}_{shard:03d}of{nshards:03d}.csv")
+
+
+# -------------------------------------------------------------------
+def plan_shards(data, param, nshards):
+    """plan_shards(data, param, nshards)
+
+    Deterministically assigns all work units (station, step, reforecast)
+    to 'nshards' shards. All steps of a station (per forecast type) go to
+    the same shard, so that each shard only reads its own stations. These
+    blocks are weighted by their expected size (number of rows times number
+    of columns of the CSV files) and distributed largest first, each to the
+    shard with the lowest load so far (ties go to the lower shard index).
+    Only uses the dimensions of the data.
+
+    Params
+    ------
+    data : dict
+        Dictionary with reforecast (bool) as key, [fcs, obs] (as returned
+        by get_data) as value.
+    param : str
+        Name of the parameter.
+    nshards : int
+        Number of shards.
+
+    Return
+    ------
+    pandas.core.frame.DataFrame : One row per unit with station_id, step
+    (in hours), reforecast, size and shard (1 to nshards).
+    """
+    assert isinstance(data, dict), TypeError("argument 'data' must be dict")
+    assert isinstance(param, str), TypeError("argument 'param' must be string")
+    assert isinstance(nshards, int) and nshards > 0, ValueError("argument 'nshards' must be positive int")
+
+    res = []
+    for reforecast in sorted(data, reverse = True):
+        [fcs, obs] = data[reforecast]
+        nrow  = int(np.prod([obs[param].sizes[k] for k in obs[param].dims if not k in ["station_id", "step"]]))
+        ncol  = fcs.sizes["number"] + 4 # yday, obs, ens_mean, ens_sd, members
+        steps = [int(x / np.timedelta64(1, "h")) for x in obs.get("step").values]
+        for station_id in obs.get("station_id").values:
+            res += [(int(station_id), step, reforecast, nrow * ncol) for step in steps]
+    res = pd.DataFrame(res, columns = ["station_id", "step", "reforecast", "size"])
+
+    # Blocks (station, reforecast); largest first, ties sorted by block to be deterministic
+    blocks = res.groupby(["station_id", "reforecast"], as_index = False)["size"].sum()
+    blocks = blocks.sort_values(["size", "reforecast", "station_id"],
+                                ascending = [False, False, True], kind = "mergesort")
+    load  = [(0, i) for i in range(1, nshards + 1)]
+    shard = []
+    for size in blocks["size"]:
+        l, i = heapq.heappop(load)
+        shard.append(i)
+        heapq.heappush(load, (l + size, i))
+    blocks["shard"] = shard
+    res = res.merge(blocks[["station_id", "reforecast", "shard"]], on = ["station_id", "reforecast"])
+    res = res.sort_values(["reforecast", "station_id", "step"], ascending = [False, True, True],
+                          kind = "mergesort").reset_index(drop = True)
+
+    log.info(f"Planned {len(res)} units on {nshards} shards; expected size per shard " + \
+             f"{res.groupby('shard')['size'].sum().min()} to {res.groupby('shard')['size'].sum().max()}")
+    return res
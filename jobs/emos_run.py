@@ -0,0 +1,320 @@
+#!/usr/bin/env python3
+# -------------------------------------------------------------------
+# Seasonally varying EMOS for all stations/steps of a country
+#
+# Python counterpart to bamlss_run.R: penalized maximum likelihood
+# with cyclic yday splines (see functions/seasonal_emos.py), fitted
+# for batches of station/steps at once on a single node instead of
+# one cluster task per station/step.
+#
+# Reads the CSV files created by prepare_stationdata.py and writes
+# one CSV per station/step (as the rds files of the R jobs) with the
+# rows of both data sets, the additional column 'split' (training/test)
+# and the predicted 'location' and 'scale' into ../results/emos[YY]/<step>/.
+#
+# With --sweep Y1 Y2 ... the models are fitted for a series of
+# training window lengths (years) in one go instead; the result is
+# a table with scores per window length and station/step in
+# ../sweeps/ (outside ../results/, not a model of the checker scripts).
+#
+# Authors: Thorsten Simon and Reto Stauffer
+# Date: 2022-09-16
+# -------------------------------------------------------------------
+
+import sys
+import os
+import re
+import glob
+import math
+import argparse
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from functions import fit_seasonal_emos, predict_seasonal_emos, sweep_seasonal_emos
+
+import logging as log
+log.basicConfig(level = log.INFO)
+
+
+# -------------------------------------------------------------------
+def find_groups(args):
+    """find_groups(args)
+
+    Return
+    ------
+    pandas.DataFrame : One row per station/step with the names of the
+    training and test CSV file as well as the output file.
+    """
+    pattern = re.compile(f"^{args.prefix}_{args.param}_{args.country}_([0-9]+)_training_([0-9]{{3}})\\.csv$")
+    res = []
+    for f in sorted(glob.glob(os.path.join(args.csvdir, f"{args.prefix}_{args.param}_{args.country}_*_training_*.csv"))):
+        mtch = pattern.match(os.path.basename(f))
+        if not mtch: continue
+        station_id, step = int(mtch.group(1)), int(mtch.group(2))
+        outfile = f"{args.model}_{args.prefix}_{args.param}_{args.country}_{station_id}_{step:03d}.csv"
+        res.append({"station_id": station_id, "step": step, "training": f,
+                    "test": f.replace("_training_", "_test_"),
+                    "outfile": os.path.join(args.outdir, args.model, f"{step:03d}", outfile)})
+    return pd.DataFrame(res, columns = ["station_id", "step", "training", "test", "outfile"])
+
+
+# -------------------------------------------------------------------
+def read_data(file, param):
+    """read_data(file, param)
+
+    Return
+    ------
+    pandas.DataFrame : Data as written by prepare_stationdata.py with
+    additional column 'log_ens_sd'.
+    """
+    data = pd.read_csv(file, parse_dates = ["valid_time"])
+    with np.errstate(divide = "ignore"):
+        data["log_ens_sd"] = np.log(data.ens_sd)
+    return data
+
+
+# -------------------------------------------------------------------
+def stack(data, cols):
+    """stack(data, cols)
+
+    Stacks a list of data frames into arrays of shape (groups, rows),
+    padded with NaN.
+
+    Return
+    ------
+    dict : One numpy.ndarray per column.
+    """
+    nrow = max(len(x) for x in data)
+    res  = {}
+    for k in cols:
+        res[k] = np.full((len(data), nrow), np.nan)
+        for i, x in enumerate(data): res[k][i, :len(x)] = x[k].values
+    return res
+
+
+# -------------------------------------------------------------------
+def fittable(yday, complete, nrow, na_limit = 0.2, min_per_bin = 60, binwidth = 30):
+    """fittable(yday, complete, nrow, na_limit = 0.2, min_per_bin = 60, binwidth = 30)
+
+    Missing-data rule of the R jobs (see functions/get_data_quality.py)
+    on stacked arrays of shape (groups, rows).
+
+    Return
+    ------
+    numpy.ndarray : Boolean, one element per group.
+    """
+    n_na  = nrow - complete.sum(axis = 1)
+    nbins = 366 // binwidth
+    ybin  = np.where((yday > 0) & (yday <= nbins * binwidth), np.ceil(yday / binwidth) - 1, -1)
+    nbin  = np.stack([np.sum(complete & (ybin == i), axis = 1) for i in range(nbins)], axis = 1)
+    return (complete.sum(axis = 1) > 0) & (~(n_na > nrow * na_limit) | np.all(nbin >= min_per_bin, axis = 1))
+
+
+# -------------------------------------------------------------------
+def scores(y, location, scale):
+    """scores(y, location, scale)
+
+    Mean log score (negative log-likelihood) and CRPS of the Gaussian
+    predictions per group; arrays of shape (groups, rows).
+
+    Return
+    ------
+    tuple : Number of observations, mean log score, mean CRPS (per group).
+    """
+    with np.errstate(invalid = "ignore"):
+        z    = (y - location) / scale
+        ok   = np.isfinite(z)
+        z    = np.where(ok, z, 0.)
+        pdf  = np.exp(-0.5 * z**2) / math.sqrt(2. * math.pi)
+        cdf  = 0.5 * (1. + np.vectorize(math.erf)(z / math.sqrt(2.)))
+        logs = np.where(ok, np.log(scale) + 0.5 * z**2 + 0.5 * math.log(2. * math.pi), 0.)
+        crps = np.where(ok, scale * (z * (2. * cdf - 1.) + 2. * pdf - 1. / math.sqrt(math.pi)), 0.)
+        n    = ok.sum(axis = 1)
+        return n, logs.sum(axis = 1) / n, crps.sum(axis = 1) / n
+
+
+# -------------------------------------------------------------------
+def sweep(args):
+    """sweep(args)
+
+    Fits all window lengths in args.sweep for each station/step; data
+    is read once. Windows are defined as in the R jobs (-y), i.e. a
+    row is in the window of 'y' years if its valid time plus step
+    falls into the last 'y' years up to 2017. Station/steps failing the
+    missing-data rule in a window are not fitted for this window; their
+    log-likelihood and scores are NaN.
+
+    Params
+    ------
+    args : argparse.Namespace
+        Parsed arguments, object as returned by parse_args().
+
+    Return
+    ------
+    No return, writes the results table into args.sweepdir.
+    """
+    assert isinstance(args, argparse.Namespace), TypeError("argument 'args' must be argparse.Namespace")
+    args.model = "emos"
+    windows = sorted(set(args.sweep))
+    outfile = os.path.join(args.sweepdir, f"emos_sweep_{args.prefix}_{args.param}_{args.country}.csv")
+    if os.path.isfile(outfile):
+        print(f"Output file {outfile} exists - skip.")
+        return None
+
+    groups = find_groups(args)
+    log.info(f"Found {len(groups)} station/steps for {args.country}; windows {windows}")
+
+    cols = [f"{args.param}_obs", "yday", "ens_mean", "log_ens_sd"]
+    res  = []
+    for b in range(0, len(groups), args.batchsize):
+        batch = groups.iloc[b:(b + args.batchsize)]
+        log.info(f"Batch {b // args.batchsize + 1}: station/steps {b + 1} to {b + len(batch)} of {len(groups)}")
+
+        train = [read_data(f, args.param) for f in batch.training]
+        test  = [read_data(f, args.param) for f in batch.test]
+        # Age in years (0 = 2017); window of 'y' years contains all rows with age < y
+        for x, s in zip(train, batch.step):
+            x["age"] = (2017 - (x.valid_time + pd.Timedelta(hours = s)).dt.year).clip(lower = 0)
+
+        tr = stack(train, cols + ["age"])
+        te = stack(test, cols)
+        complete = np.all(np.stack([np.isfinite(tr[k]) for k in cols]), axis = 0)
+
+        # Missing-data rule per window; station/steps failing it are not fitted
+        ok_all = np.stack([fittable(np.where(tr["age"] < window, tr["yday"], np.nan), complete & (tr["age"] < window),
+                                    (tr["age"] < window).sum(axis = 1)) for window in windows], axis = 1)
+
+        coefs = sweep_seasonal_emos(*[tr[k] for k in cols], tr["age"], windows,
+                                    nknots = args.nknots, lam = (args.lam, args.lam), mask = ok_all)
+        for j, (window, coef) in enumerate(zip(windows, coefs)):
+            ok = ok_all[:, j] & np.all(np.isfinite(coef["beta"]), axis = 1)
+            n, logs, crps = scores(te[cols[0]], *predict_seasonal_emos(coef, te["yday"], te["ens_mean"], te["log_ens_sd"]))
+            # Not fittable with this window or not estimable
+            ll = np.where(ok, coef["loglik"], np.nan)
+            n, logs, crps = np.where(ok, n, 0), np.where(ok, logs, np.nan), np.where(ok, crps, np.nan)
+            res.append(pd.DataFrame({"years": window, "station_id": batch.station_id.values, "step": batch.step.values,
+                                     "nobs": coef["nobs"], "fittable": ok_all[:, j], "converged": coef["converged"] & ok,
+                                     "loglik": ll, "test_nobs": n, "test_logs": logs, "test_crps": crps}))
+
+    res = pd.concat(res).sort_values(["years", "station_id", "step"]).set_index("years")
+    if not os.path.isdir(os.path.dirname(outfile)):
+        try: os.makedirs(os.path.dirname(outfile))
+        except Exception as e: raise Exception(e)
+    log.info(f"Writing {outfile}")
+    res.to_csv(outfile)
+
+
+# -------------------------------------------------------------------
+def main(args):
+    """main(args)
+
+    Params
+    ------
+    args : argparse.Namespace
+        Parsed arguments, object as returned by parse_args().
+
+    Return
+    ------
+    No return, writes the results into args.outdir.
+    """
+    assert isinstance(args, argparse.Namespace), TypeError("argument 'args' must be argparse.Namespace")
+    args.model = "emos" if args.years >= 100 else f"emos{args.years:02d}"
+
+    groups = find_groups(args)
+    log.info(f"Found {len(groups)} station/steps for {args.country}")
+    groups = groups.loc[~groups.outfile.map(os.path.isfile)].reset_index(drop = True)
+    log.info(f"{len(groups)} station/steps not yet on disc, estimate models ...")
+
+    cols = [f"{args.param}_obs", "yday", "ens_mean", "log_ens_sd"]
+    for b in range(0, len(groups), args.batchsize):
+        batch = groups.iloc[b:(b + args.batchsize)]
+        log.info(f"Batch {b // args.batchsize + 1}: station/steps {b + 1} to {b + len(batch)} of {len(groups)}")
+
+        train = [read_data(f, args.param) for f in batch.training]
+        test  = [read_data(f, args.param) for f in batch.test]
+
+        # Cutting training data set to 'years' years (as in the R jobs)
+        if args.years < 100:
+            begin = pd.Timestamp(f"{2017 + 1 - args.years:04d}-01-01")
+            train = [x.loc[x.valid_time >= begin - pd.Timedelta(hours = s)].reset_index(drop = True)
+                     for x, s in zip(train, batch.step)]
+
+        tr = stack(train, cols)
+        te = stack(test, cols)
+
+        # Missing values; rows of the (unpadded) training data sets
+        complete = np.all(np.stack([np.isfinite(tr[k]) for k in cols]), axis = 0)
+        nrow     = np.array([len(x) for x in train])
+        ok       = fittable(tr["yday"], complete, nrow)
+        if not np.all(ok):
+            log.warning(f"Not enough data for {np.sum(~ok)} station/steps, skip: " + \
+                        ", ".join(f"{s}/{t:03d}" for s, t in zip(batch.station_id[~ok], batch.step[~ok])))
+
+        coef = fit_seasonal_emos(*[np.where(ok[:, np.newaxis], tr[k], np.nan) for k in cols],
+                                 nknots = args.nknots, lam = (args.lam, args.lam))
+        pred = {"training": predict_seasonal_emos(coef, tr["yday"], tr["ens_mean"], tr["log_ens_sd"]),
+                "test":     predict_seasonal_emos(coef, te["yday"], te["ens_mean"], te["log_ens_sd"])}
+
+        # Too few observations to identify the model or numerical failure
+        failed = ok & ~np.all(np.isfinite(coef["beta"]), axis = 1)
+        if np.any(failed):
+            log.warning(f"Model not estimable for {np.sum(failed)} station/steps, skip: " + \
+                        ", ".join(f"{s}/{t:03d}" for s, t in zip(batch.station_id[failed], batch.step[failed])))
+            ok = ok & ~failed
+
+        # Writing results; rows/columns of both inputs plus split, location and scale
+        for i, rec in enumerate(batch.itertuples()):
+            if not ok[i]: continue
+            res = []
+            for k, data in [("training", train[i]), ("test", test[i])]:
+                tmp = data.drop(columns = "log_ens_sd")
+                tmp.insert(0, "split", k)
+                tmp["location"] = pred[k][0][i, :len(tmp)]
+                tmp["scale"]    = pred[k][1][i, :len(tmp)]
+                res.append(tmp)
+            if not os.path.isdir(os.path.dirname(rec.outfile)):
+                try: os.makedirs(os.path.dirname(rec.outfile))
+                except Exception as e: raise Exception(e)
+            pd.concat(res, ignore_index = True).to_csv(rec.outfile, index = False)
+
+
+# -------------------------------------------------------------------
+# Main part of the Script
+# -------------------------------------------------------------------
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(f"{sys.argv[0]}")
+    parser.add_argument("-c", "--country",
+            choices = ["germany", "france", "netherlands", "switzerland", "austria"],
+            type = str.lower, default = "germany",
+            help = "Name of the country to be processed.")
+    parser.add_argument("-p", "--param", type = str.lower, default = "t2m",
+            help = "Name of the parameter to be processed.")
+    parser.add_argument("-y", "--years", type = int, default = 9999,
+            help = "Positive integer, number of years to use from the training data set; by default 'all'.")
+    parser.add_argument("--prefix", type = str, default = "euppens",
+            help = "Prefix of the CSV files created by prepare_stationdata.py.")
+    parser.add_argument("--csvdir", type = str, default = os.path.join("..", "euppens"),
+            help = "Directory containing the CSV files.")
+    parser.add_argument("--outdir", type = str, default = os.path.join("..", "results"),
+            help = "Output directory.")
+    parser.add_argument("--sweepdir", type = str, default = os.path.join("..", "sweeps"),
+            help = "Output directory of the sweep mode (--sweep).")
+    parser.add_argument("-k", "--nknots", type = int, default = 10,
+            help = "Number of cyclic B-spline basis functions per smooth term.")
+    parser.add_argument("--lam", type = float, default = 10.,
+            help = "Smoothing parameter (penalty on second differences).")
+    parser.add_argument("-b", "--batchsize", type = int, default = 200,
+            help = "Number of station/steps fitted simultaneously.")
+    parser.add_argument("--sweep", type = int, nargs = "+", default = None,
+            help = "Sweep mode; list of training window lengths (years, 9999 = all) fitted in one go. Ignores -y/--years.")
+    args = parser.parse_args()
+    if args.years <= 0: raise ValueError("argument -y/--years must be positive")
+    if args.sweep and min(args.sweep) <= 0: raise ValueError("argument --sweep must be positive")
+
+    if args.sweep:
+        sweep(args)
+    else:
+        main(args)
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+# -------------------------------------------------------------------
+# Merging the output of prepare_stationdata.py --shard i/N
+#
+# Checks that all shards are complete and that the station/steps
+# cover all stations of the station meta data, combines the partial
+# data quality tables of the shards, and stores the CSV files in the
+# final zip file (same content as an unsharded run).
+# Does not access the zarr stores.
+#
+# Authors: Thorsten Simon and Reto Stauffer
+# Date: 2022-09-16
+# -------------------------------------------------------------------
+
+import sys
+import os
+import argparse
+
+import pandas as pd
+
+from functions import create_zip, get_shard_filename
+
+import logging as log
+log.basicConfig(level = log.INFO)
+
+
+def find_file(dirs, file):
+    """find_file(dirs, file)
+
+    Return
+    ------
+    str or None : Path of 'file' in the first directory of 'dirs' where it exists.
+    """
+    for d in dirs:
+        if os.path.isfile(os.path.join(d, file)): return os.path.join(d, file)
+    return None
+
+
+def main(args):
+    """main(args)
+
+    Params
+    ------
+    args : argparse.Namespace or dict
+        Parsed argument, object as returned by parse_args().
+        Must contain 'country' (str), 'param' (str), 'prefix' (str),
+        'nshards' (int) and 'input' (list of directories).
+
+    Return
+    ------
+    No return, creates the final zip file in the best case. Raises an
+    Exception if shards, station/steps, or parts of the data quality
+    table are missing.
+    """
+    if isinstance(args, dict): args = argparse.Namespace(**args)
+    assert isinstance(args, argparse.Namespace), TypeError("argument 'args' must be argparse.Namespace")
+    assert isinstance(args.prefix, str),  TypeError("args.prefix must be str")
+    assert isinstance(args.country, str), TypeError("args.country must be str")
+    assert isinstance(args.param, str),   TypeError("args.param must be str")
+    assert isinstance(args.nshards, int) and args.nshards > 0, ValueError("args.nshards must be positive int")
+    dirs = args.input if args.input else [args.prefix]
+
+    final_zip = os.path.join(args.prefix, f"{args.prefix}_{args.param}_{args.country}.zip")
+    if os.path.isfile(final_zip):
+        print(f"Final file {final_zip} exists; do not continue (return None)")
+        return None
+
+    # ---------------------------------------------------------------
+    # Reading shard manifests
+    # ---------------------------------------------------------------
+    manifests = []
+    for shard in range(1, args.nshards + 1):
+        f = find_file(dirs, os.path.basename(get_shard_filename(args, shard, args.nshards)))
+        if f is None: raise Exception(f"manifest for shard {shard}/{args.nshards} not found (shard not finished?)")
+        manifests.append(f)
+    plan = pd.concat([pd.read_csv(f) for f in manifests], ignore_index = True)
+    if plan.duplicated(["station_id", "step", "reforecast"]).any():
+        raise Exception("station/steps processed by more than one shard")
+
+    # ---------------------------------------------------------------
+    # Coverage: all stations of the station meta data, all steps
+    # ---------------------------------------------------------------
+    files = []
+    for reforecast in [True, False]:
+        ftype = "reforecasts" if reforecast else "forecasts"
+        meta_csv = find_file(dirs, f"{args.prefix}_{args.param}_{args.country}_stationdata_{ftype}.csv")
+        if meta_csv is None: raise Exception(f"station meta data for {ftype} not found")
+        files.append(meta_csv)
+
+        tmp      = plan.loc[plan.reforecast == reforecast]
+        expected = set(pd.read_csv(meta_csv).station_id)
+        if set(tmp.station_id) != expected:
+            raise Exception(f"stations in shards and station meta data differ ({ftype}); " + \
+                            f"missing: {sorted(expected - set(tmp.station_id))}, " + \
+                            f"unexpected: {sorted(set(tmp.station_id) - expected)}")
+        steps = set(tmp.step)
+        if len(tmp) != len(expected) * len(steps):
+            raise Exception(f"not all steps {sorted(steps)} available for all stations ({ftype})")
+
+    # ---------------------------------------------------------------
+    # Data quality table; one part per shard with reforecast stations,
+    # same row order as in an unsharded run (station meta data order)
+    # ---------------------------------------------------------------
+    parts = []
+    for shard in sorted(plan.shard[plan.reforecast].unique()):
+        f = find_file(dirs, os.path.basename(get_shard_filename(args, int(shard), args.nshards, "quality")))
+        if f is None: raise Exception(f"data quality table of shard {shard}/{args.nshards} not found")
+        parts.append(f)
+    quality = pd.concat([pd.read_csv(f, float_precision = "round_trip") for f in parts], ignore_index = True)
+    stations = pd.read_csv(find_file(dirs, f"{args.prefix}_{args.param}_{args.country}_stationdata_reforecasts.csv")).station_id
+    if set(quality.station_id) != set(stations):
+        raise Exception("stations in data quality table and station meta data differ (reforecasts)")
+    quality["pos"] = quality.station_id.map(dict(zip(stations, range(len(stations)))))
+    quality = quality.sort_values(["years", "pos", "step"], ascending = [False, True, True], kind = "mergesort")
+    quality_csv = os.path.join(args.prefix, f"{args.prefix}_{args.param}_{args.country}_quality_reforecasts.csv")
+
+    missing = []
+    for f in plan.csvfile:
+        path = find_file(dirs, f)
+        if path is None: missing.append(f)
+        else:            files.append(path)
+    if len(missing) > 0:
+        raise Exception(f"{len(missing)} CSV files missing, e.g. {missing[:3]}")
+    log.info(f"All {len(plan)} station/steps of {args.nshards} shards found")
+
+    # ---------------------------------------------------------------
+    # Create final zip file; remove manifests and parts if successful
+    # ---------------------------------------------------------------
+    if not os.path.isdir(args.prefix):
+        try: os.makedirs(args.prefix)
+        except Exception as e: raise Exception(e)
+    quality.drop(columns = "pos").to_csv(quality_csv, index = False)
+    files.append(quality_csv)
+    if create_zip(final_zip, files):
+        for f in manifests + parts: os.remove(f)
+
+
+# -------------------------------------------------------------------
+# Main part of the Script
+# -------------------------------------------------------------------
+if __name__ == "__main__":
+
+    # ---------------------------------------------------------------
+    # Parsing console arguments
+    # ---------------------------------------------------------------
+    parser = argparse.ArgumentParser(f"{sys.argv[0]}")
+    parser.add_argument("-c", "--country",
+            choices = ["germany", "france", "netherlands", "switzerland", "austria"],
+            type = str.lower, default = "germany",
+            help = "Name of the country to be processed.")
+    parser.add_argument("-p", "--param", type = str.lower, default = "t2m",
+            help = "Name of the parameter to be processed.")
+    parser.add_argument("--prefix", type = str, default = "euppens",
+            help = "Prefix used in prepare_stationdata.py; the final zip file is stored in this directory.")
+    parser.add_argument("-N", "--nshards", type = int, required = True,
+            help = "Number of shards (N in --shard i/N).")
+    parser.add_argument("-i", "--input", type = str, nargs = "+", default = None,
+            help = "Directories containing the shard outputs (e.g., copied from different hosts). Defaults to the prefix directory.")
+    args = parser.parse_args()
+
+    main(args)
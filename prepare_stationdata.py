@@ -18,7 +18,6 @@ import glob
 import pickle
 import fsspec
 import argparse
-from zipfile import ZipFile
 
 import xarray as xr
 import pandas as pd
@@ -38,11 +37,15 @@ def main(args):
     args : argparse.Namespace or dict
         Parsed argument, object as returned by parse_args().
         Must contain 'country' (str), 'param' (str), and 'nocache' (bool).
+        Optional 'shard' (str 'i/N') to only process part of the station/steps,
+        'server' (str) and 'storage_options' (dict) passed on to get_data.
         If it is a dictionary, it will be converted into argparse.Namespace internally.
 
     Return
     ------
     No return, but saves a bunch of files into CSVDIR in the best case.
+    In shard mode no zip file is created but a shard manifest (see
+    merge_stationdata.py).
     """
     if isinstance(args, dict): args = argparse.Namespace(**args)
     assert isinstance(args, argparse.Namespace), TypeError("argument 'args' must be argparse.Namespace")
@@ -68,28 +71,64 @@ def main(args):
         try: os.makedirs(args.prefix)
         except Exception as e: raise Exception(e)
 
+    # ---------------------------------------------------------------
+    # Loading data (uses cache file if existing)
+    # ---------------------------------------------------------------
+    datasets = {}
+    for reforecast in [True, False]:
+        datasets[reforecast] = get_data(args.country, args.param, reforecast, do_cache = not args.nocache,
+                                        server_path = getattr(args, "server", None),
+                                        storage_options = getattr(args, "storage_options", None))
+
+    # ---------------------------------------------------------------
+    # Shard mode: only process the units assigned to this shard
+    # ---------------------------------------------------------------
+    shard = getattr(args, "shard", None)
+    if shard is not None:
+        shard, nshards = parse_shard(shard)
+        plan  = plan_shards(datasets, args.param, nshards)
+        plan  = plan.loc[plan.shard == shard].reset_index(drop = True)
+        units = set(zip(plan.station_id, plan.step, plan.reforecast))
+        log.info(f"Shard {shard}/{nshards}: processing {len(units)} units")
 
     # ---------------------------------------------------------------
     # Looping over all stations/steps
     # ---------------------------------------------------------------
     for reforecast in [True, False]:
 
-        # ---------------------------------------------------------------
-        # Loading data (uses cache file if existing)
-        # ---------------------------------------------------------------
-        [fcs, obs] = get_data(args.country, args.param, reforecast, do_cache = not args.nocache)
+        [fcs, obs] = datasets[reforecast]
 
         # ---------------------------------------------------------------
-        # Fetching station meta if needed
+        # Fetching station meta if needed (coordinates only; shard 1 in shard mode)
         # ---------------------------------------------------------------
         ftype = "reforecasts" if reforecast else "forecasts"
         station_meta_csv = os.path.join(args.prefix, f"{args.prefix}_{args.param}_{args.country}_stationdata_{ftype}.csv")
-        if args.nocache or not os.path.isfile(station_meta_csv):
+        if (shard is None or shard == 1) and (args.nocache or not os.path.isfile(station_meta_csv)):
             log.info("Extracting station meta data")
             station_meta = get_station_meta(fcs, obs)
             station_meta.to_csv(station_meta_csv, index = False)
             del station_meta # Not used anymore in this script
 
+        # ---------------------------------------------------------------
+        # Data quality table (training data only); flags station/steps
+        # which do not meet the missing-data rule of the model jobs for
+        # the training windows used (all years and -y 3). In shard mode
+        # each shard only covers its own stations (combined by
+        # merge_stationdata.py).
+        # ---------------------------------------------------------------
+        if shard is None:
+            quality_csv = os.path.join(args.prefix, f"{args.prefix}_{args.param}_{args.country}_quality_{ftype}.csv")
+            stations    = obs.get("station_id").values
+        else:
+            quality_csv = get_shard_filename(args, shard, nshards, "quality")
+            stations    = plan.station_id[plan.reforecast].unique()
+        if reforecast and len(stations) > 0 and (args.nocache or not os.path.isfile(quality_csv)):
+            log.info("Calculating data quality table")
+            quality = get_data_quality(fcs.sel(station_id = stations), obs.sel(station_id = stations),
+                                       args.param, years = [9999, 3])
+            quality.to_csv(quality_csv, index = False)
+            del quality
+
         # ---------------------------------------------------------------
         # Time check
         # ---------------------------------------------------------------
@@ -106,6 +145,7 @@ def main(args):
             for step in obs.get("step").values:
                 # Convert forecast step to hours
                 step_hours = int(step / 1e9 / 3600) # convert to hours
+                if shard is not None and not (station_id, step_hours, reforecast) in units: continue
                 log.info(f"Processing data for station {station_id:5d} {step_hours:+4d}h ahead; {reforecast=}.")
 
                 # -----------------------------------
@@ -164,30 +204,28 @@ def main(args):
                 del tmp_mean, tmp_std, yday, csvfile
                 del subset, data, df_fcs, df_obs
 
+    # ---------------------------------------------------------------
+    # Shard mode: write manifest, zip file is created by merge_stationdata.py
+    # ---------------------------------------------------------------
+    if shard is not None:
+        plan["csvfile"] = [os.path.basename(get_csv_filename(args, int(x.station_id), int(x.step), bool(x.reforecast)))
+                           for x in plan.itertuples()]
+        shard_csv = get_shard_filename(args, shard, nshards)
+        log.info(f"Shard {shard}/{nshards} done, writing {shard_csv}")
+        plan.to_csv(shard_csv, index = False)
+        return None
+
     # ---------------------------------------------------------------
     # All stations processes
     # ---------------------------------------------------------------
     log.info(f"All stations processed for {args.country}, {args.param}, create zip file")
 
     # Find files to be zipped
-    keepwd = os.getcwd()
-    os.chdir(os.path.dirname(final_zip))
-    pattern = re.compile(f"{args.prefix}_{args.param}_{args.country}_.*\.csv$")
+    pattern = re.compile(f"{args.prefix}_{args.param}_{args.country}_.*\\.csv$")
     files = []
-    for f in glob.glob("*"):
-        if pattern.match(f): files.append(f)
-    files.sort()
-    try:
-        with ZipFile(os.path.basename(final_zip), "w") as fid:
-            for f in files:
-                fid.write(f) # Store in zip
-    except:
-        log.error("Problems with zipping do not delete files")
-        if os.path.isfile(final_zip): os.remove(final_zip)
-    finally:
-        log.info("Zip file created, delete source files")
-        for f in files: os.remove(f)
-    os.chdir(keepwd)
+    for f in glob.glob(os.path.join(args.prefix, "*")):
+        if pattern.match(os.path.basename(f)): files.append(f)
+    create_zip(final_zip, files)
 
 
 # -------------------------------------------------------------------
@@ -209,6 +247,10 @@ if __name__ == "__main__":
             help = "Used as name of the output directory for the results as well as prefix for all files created by this script.")
     parser.add_argument("-n", "--nocache", action = "store_true", default = False,
             help = "Disables auto-caching zarr file content (stored as pickle files). Defaults to 'False' (will do caching). Also forces all files to be recreated.")
+    parser.add_argument("--shard", type = str, default = None,
+            help = "Only process shard 'i/N' (1 <= i <= N) of all station/steps; combine the results with merge_stationdata.py.")
+    parser.add_argument("--server", type = str, default = None,
+            help = "Alternative base URL of the stations_data zarr stores (e.g., a local mock server). Defaults to the EUPP storage.")
     args = parser.parse_args()
     if not args.country:
         parser.print_help()